@@ -1,15 +1,27 @@
 """
 Defines a generic interface to observation catalog
 """
+from functools import lru_cache
+from types import MappingProxyType
+
 import numpy as np
 from numpy.random import default_rng
 
-from astropy.table import Table, Column
+import astropy
+from astropy.table import Table
+from astropy.utils import minversion
 
+from beast.config import __USE_NUMEXPR__
 from beast.observationmodel.vega import Vega
 from beast.physicsmodel.priormodel import PriorAgeModel, PriorMassModel
 from beast.physicsmodel.grid_weights_stars import compute_bin_boundaries
 
+if __USE_NUMEXPR__:
+    import numexpr
+
+# mask_invalid for the FITS table reader was added in astropy 5.1
+_ASTROPY_LT_5_1 = not minversion(astropy, "5.1")
+
 __all__ = ["Observations", "gen_SimObs_from_sedgrid"]
 
 
@@ -56,11 +68,11 @@ class Observations(object):
         else:
             self.desc = desc
         self.inputFile = inputFile
-        self.setFilters(filters)
         self.filter_aliases = {}
         for ik, k in enumerate(filters):
             self.filter_aliases[k] = obs_colnames[ik]
         self.readData()
+        self.setFilters(filters)
         self.setVegaFluxes(filters, vega_fname=vega_fname)
         # some bad values smaller than expected
         # in physical flux units
@@ -121,6 +133,29 @@ class Observations(object):
 
     def setFilters(self, filters):
         self.filters = filters
+        self._build_flux_matrices()
+
+    def _build_flux_matrices(self):
+        """
+        Stack the flux columns of the filters into a (nObs, n_filters) array
+        so per-star fluxes are a simple row gather, the flux error array is
+        reset and built by getFluxerr when first needed
+        """
+        if self.filters is None:
+            self._alias_list = ()
+            self._flux_matrix = None
+            self._fluxerr_matrix = None
+            return
+
+        self._alias_list = tuple(self.filter_aliases[ok] for ok in self.filters)
+        self._flux_matrix = np.column_stack(
+            [
+                np.asarray(self.data[alias], dtype=np.float64)
+                for alias in self._alias_list
+            ]
+        )
+        # flux errors are not used in the analysis, built on first use
+        self._fluxerr_matrix = None
 
     def setVegaFluxes(self, filters, vega_fname=None):
         """
@@ -134,9 +169,7 @@ class Observations(object):
             name of the file with the vega model spectrum
         """
         # for optimization purpose: pre-compute
-        with Vega(source=vega_fname) as v:
-            _, vega_flux, _ = v.getFlux(filters)
-        self.vega_flux = vega_flux
+        self.vega_flux = _vega_flux_cached(vega_fname, tuple(filters))
 
     def getFlux(self, num, units=False):
         """
@@ -155,32 +188,52 @@ class Observations(object):
             Measured integrated flux values throughout the filters
             in erg/s/cm^2/A
         """
-        if self.vega_flux is None:
-            raise ValueError("vega_flux not set, can't return fluxes")
-
         # case for using '_flux' result
-        d = self.data[num]
-
-        flux = (
-            np.array([d[self.filter_aliases[ok]] for ok in self.filters])
-            * self.vega_flux
-        )
+        flux = self.getFluxes(num)
 
         if units is True:
             return flux * units.erg / (units.s * units.cm * units.cm * units.angstrom)
         else:
             return flux
 
+    def getFluxes(self, indices=None):
+        """
+        Fluxes of many observations computed from normalized vega fluxes
+
+        Parameters
+        ----------
+        indices : int, slice, or array-like, optional
+            indices of the stars in the catalog to get measurements from,
+            default is all the stars
+
+        Returns
+        -------
+        fluxes : ndarray[dtype=float]
+            Measured integrated flux values throughout the filters
+            in erg/s/cm^2/A, shape (n_stars, n_filters) or (n_filters,)
+            if indices is an int
+        """
+        if self.vega_flux is None:
+            raise ValueError("vega_flux not set, can't return fluxes")
+
+        if indices is None:
+            mat = self._flux_matrix
+        else:
+            mat = self._flux_matrix[indices]
+
+        return mat * self.vega_flux
+
     def getFluxerr(self, num):
         """returns the error on the flux of an observation from the number of
         counts (not used in the analysis)"""
+        if self._fluxerr_matrix is None:
+            # flux errors are optional in the catalog, missing ones are NaN
+            self._fluxerr_matrix = np.full((self.nObs, len(self.filters)), np.nan)
+            for ek, ok in enumerate(self.filters):
+                if ok + "_err" in self.data.colnames:
+                    self._fluxerr_matrix[:, ek] = np.asarray(self.data[ok + "_err"])
 
-        fluxerr = np.zeros(len(self.filters), dtype=float)
-
-        for ek, ok in enumerate(self.filters):
-            fluxerr[ek] = self.data[ok + "_err"][num]
-
-        return fluxerr
+        return self._fluxerr_matrix[num].copy()
 
     def getObs(self, num=0):
         """ returns the flux"""
@@ -195,18 +248,141 @@ class Observations(object):
         """ read the dataset from the original source file """
 
         if isinstance(self.inputFile, str):
-            self.data = Table.read(self.inputFile)
+            # give the reader explicitly to avoid the format guessing and
+            # the slow pure python ascii readers
+            fname = self.inputFile.lower()
+            if fname.endswith((".fits", ".fits.gz", ".fit", ".fit.gz")):
+                # bad measurements are tagged with badvalue, so do not make
+                # MaskedColumns for NaN values when astropy would do so
+                if _ASTROPY_LT_5_1:
+                    self.data = Table.read(self.inputFile, memmap=True)
+                else:
+                    self.data = Table.read(
+                        self.inputFile, memmap=True, mask_invalid=False
+                    )
+            elif fname.endswith(".csv"):
+                self.data = Table.read(
+                    self.inputFile,
+                    format="ascii.csv",
+                    fast_reader={"use_fast_converter": True},
+                )
+            elif fname.endswith(".tsv"):
+                self.data = Table.read(
+                    self.inputFile,
+                    format="ascii.tab",
+                    fast_reader={"use_fast_converter": True},
+                )
+            else:
+                self.data = Table.read(self.inputFile)
         else:
             self.data = self.inputFile
 
     def iterobs(self):
-        """ yield getObs """
-        for k in range(self.nObs):
-            yield self.getObs(k)
+        """
+        yield getObs
+
+        The fluxes of all the stars are computed at once and the yielded
+        fluxes are views into that shared (nObs, n_filters) array,
+        copy them before modifying
+        """
+        if self.filters is None:
+            raise AttributeError("No filter set provided.")
+
+        # compute all the fluxes at once instead of one getObs call per star
+        all_flux = self.getFluxes()
+        for flux in all_flux:
+            yield flux
 
     def enumobs(self):
-        for k in range(self.nObs):
-            yield k, self.getObs(k)
+        """
+        yield the index and getObs
+
+        As for iterobs, the yielded fluxes are views into a shared
+        (nObs, n_filters) array, copy them before modifying
+        """
+        if self.filters is None:
+            raise AttributeError("No filter set provided.")
+
+        all_flux = self.getFluxes()
+        for k, flux in enumerate(all_flux):
+            yield k, flux
+
+
+@lru_cache(maxsize=16)
+def _vega_flux_cached(vega_fname, filters):
+    """
+    Vega fluxes in the filters, cached to avoid rereading the vega file
+
+    Parameters
+    ----------
+    vega_fname : str
+        name of the file with the vega model spectrum, None for the default
+    filters : tuple
+        filter names using the internally normalized namings
+
+    Returns
+    -------
+    vega_flux : ndarray
+        read-only vega fluxes in the filters
+    """
+    with Vega(source=vega_fname) as v:
+        _, vega_flux, _ = v.getFlux(list(filters))
+    vega_flux.setflags(write=False)
+    return vega_flux
+
+
+@lru_cache(maxsize=32)
+def _short_filter_map(filters):
+    """
+    Short (band only) names of the filters
+
+    Parameters
+    ----------
+    filters : tuple
+        full filter names (e.g., HST_WFC3_F275W)
+
+    Returns
+    -------
+    short_filters : tuple
+        uppercase band names (e.g., F275W)
+    short_filters_indx : mapping
+        read-only index of each band name in filters, the first filter is
+        used if several have the same band name
+    """
+    short_filters = tuple(
+        filter.rsplit(sep="_", maxsplit=1)[-1].upper() for filter in filters
+    )
+    short_filters_indx = {}
+    for k, sname in enumerate(short_filters):
+        short_filters_indx.setdefault(sname, k)
+    return short_filters, MappingProxyType(short_filters_indx)
+
+
+def _rate_to_vegamag(rate):
+    """
+    Convert vega normalized fluxes to vega magnitudes
+
+    Parameters
+    ----------
+    rate : ndarray
+        fluxes divided by the vega fluxes
+
+    Returns
+    -------
+    mag : ndarray
+        vega magnitudes with the dtype of rate,
+        non-positive rates are set to 99.999
+    """
+    # single fused pass if numexpr is available,
+    # the log10 of non-positive rates is never used
+    if __USE_NUMEXPR__:
+        mag = numexpr.evaluate("where(rate <= 0.0, 99.999, -2.5 * log10(rate))")
+    else:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mag = np.where(rate <= 0.0, 99.999, -2.5 * np.log10(rate))
+
+    # the float constants should not change the precision of the rates
+    return mag.astype(rate.dtype, copy=False)
 
 
 def gen_SimObs_from_sedgrid(
@@ -221,6 +397,7 @@ def gen_SimObs_from_sedgrid(
     weight_to_use="weight",
     age_prior_model=None,
     mass_prior_model=None,
+    dtype=np.float64,
 ):
     """
     Generate simulated observations using the physics and observation grids.
@@ -273,17 +450,28 @@ def gen_SimObs_from_sedgrid(
     mass_prior_model : dict
         mass prior model in the BEAST dictonary format
 
+    dtype : numpy dtype, optional
+        precision of the simulated fluxes, rates, and magnitudes
+        (default=np.float64), only np.float32 and np.float64 are supported
+        np.float32 halves the memory used and is enough for photometry
+
     Returns
     -------
     simtable : astropy Table
         table giving the simulated observed fluxes as well as the
         physics model parmaeters
     """
+    if np.dtype(dtype) not in (np.dtype(np.float32), np.dtype(np.float64)):
+        raise ValueError(f"dtype {dtype} not supported, use np.float32 or np.float64")
+
     n_models, n_filters = sedgrid.seds.shape
     flux = sedgrid.seds
 
+    # short (band only) filter names used for completeness and output columns
+    short_filters, short_filters_indx = _short_filter_map(tuple(sedgrid.filters))
+
     # get the vega fluxes for the filters
-    _, vega_flux, _ = Vega(source=vega_fname).getFlux(sedgrid.filters)
+    vega_flux = _vega_flux_cached(vega_fname, tuple(sedgrid.filters))
 
     # cache the noisemodel values
     model_bias = sedgrid_noisemodel["bias"]
@@ -308,10 +496,7 @@ def gen_SimObs_from_sedgrid(
     if compl_filter.lower() == "max":
         model_compl = np.max(model_compl, axis=1)
     else:
-        short_filters = [
-            filter.split(sep="_")[-1].upper() for filter in sedgrid.filters
-        ]
-        if compl_filter.upper() not in short_filters:
+        if compl_filter.upper() not in short_filters_indx:
             raise NotImplementedError(
                 "Requested completeness filter not present:"
                 + compl_filter.upper()
@@ -319,7 +504,7 @@ def gen_SimObs_from_sedgrid(
                 + "\n".join(short_filters)
             )
 
-        filter_k = short_filters.index(compl_filter.upper())
+        filter_k = short_filters_indx[compl_filter.upper()]
         print("Completeness from %s" % sedgrid.filters[filter_k])
         model_compl = model_compl[:, filter_k]
 
@@ -334,7 +519,6 @@ def gen_SimObs_from_sedgrid(
 
     # if the age and mass prior models are given, use them to determine the
     # total number of stars to simulate
-    model_indx = np.arange(n_models)
     if (age_prior_model is not None) and (mass_prior_model is not None):
         nsim = 0
         # logage_range = [min(sedgrid["logA"]), max(sedgrid["logA"])]
@@ -350,8 +534,9 @@ def gen_SimObs_from_sedgrid(
 
         # compute the mass of the remaining stars at each age and
         # simulate the stars assuming everything is complete
-        gridweights = sedgrid[weight_to_use]
-        gridweights = gridweights / np.sum(gridweights)
+        # copy as the weights are normalized in place
+        gridweights = np.array(sedgrid[weight_to_use], dtype=np.float64)
+        gridweights /= gridweights.sum()
 
         grid_ages = np.unique(sedgrid["logA"])
         age_prior = PriorAgeModel(age_prior_model)
@@ -379,7 +564,7 @@ def gen_SimObs_from_sedgrid(
             if np.sum(curweights) > 0:
                 curweights /= np.sum(curweights)
                 cursim_indx = rangen.choice(
-                    model_indx[gmods], size=nsim_curage, p=curweights
+                    np.flatnonzero(gmods), size=nsim_curage, p=curweights
                 )
 
                 totsim_indx = np.concatenate((totsim_indx, cursim_indx))
@@ -397,58 +582,68 @@ def gen_SimObs_from_sedgrid(
         print(f"number of simulated stars w/ completeness = {len(sim_indx)}; mass = {totcompsimmass}")
 
     else:  # total number of stars to simulate set by command line input
+        # indices of the usable models, without an index array for all models
+        good_indx = np.flatnonzero(goodobsmod)
 
         if weight_to_use == "uniform":
             # sample to get the indices of the picked models
-            sim_indx = rangen.choice(model_indx[goodobsmod], nsim)
+            sim_indx = rangen.choice(good_indx, nsim)
 
         else:
-            gridweights = sedgrid[weight_to_use][goodobsmod] * model_compl[goodobsmod]
-            gridweights = gridweights / np.sum(gridweights)
+            gridweights = np.multiply(
+                np.asarray(sedgrid[weight_to_use])[goodobsmod],
+                model_compl[goodobsmod],
+                dtype=np.float64,
+            )
+            gridweights /= gridweights.sum()
 
             # sample to get the indexes of the picked models
-            sim_indx = rangen.choice(model_indx[goodobsmod], size=nsim, p=gridweights)
+            sim_indx = rangen.choice(good_indx, size=nsim, p=gridweights)
 
         print(f"number of simulated stars = {nsim}")
 
-    # setup the output table
-    ot = Table()
+    # simulate the fluxes for all the filters at once
+    # deviates drawn as (n_filters, nsim) so the random draws are in the same
+    # order as drawing one filter at a time, always drawn in float64 so the
+    # same ranseed gives the same simulation for any dtype
+    sim_flux_orig = flux[sim_indx, :].astype(dtype, copy=False)
+    sim_bias = model_bias[sim_indx, :].astype(dtype, copy=False)
+    sim_unc = model_unc[sim_indx, :].astype(dtype, copy=False)
+    sim_dev = rangen.standard_normal((n_filters, len(sim_indx))).T
+    sim_dev = sim_dev.astype(dtype, copy=False)
+    # single fused pass for flux + bias + noise if numexpr is available
+    if __USE_NUMEXPR__:
+        simflux_all = numexpr.evaluate("sim_flux_orig + sim_bias + sim_unc * sim_dev")
+    else:
+        simflux_all = sim_flux_orig + sim_bias + sim_unc * sim_dev
+
+    # rates and vega magnitudes for all the filters at once
+    # for both the simulated and the input physical model fluxes
+    sim_vega_flux = vega_flux.astype(dtype, copy=False)
+    simrate_all = simflux_all / sim_vega_flux[np.newaxis, :]
+    simmag_all = _rate_to_vegamag(simrate_all)
+    inrate_all = sim_flux_orig / sim_vega_flux[np.newaxis, :]
+    inmag_all = _rate_to_vegamag(inrate_all)
+
+    # setup the output table columns, the table is made once at the end
+    cols = {}
     qnames = list(sedgrid.keys())
     # simulated data
-    for k, filter in enumerate(sedgrid.filters):
-        simflux_wbias = flux[sim_indx, k] + model_bias[sim_indx, k]
-
-        simflux = rangen.normal(loc=simflux_wbias, scale=model_unc[sim_indx, k])
-
-        bname = filter.split(sep="_")[-1].upper()
-        fluxname = f"{bname}_FLUX"
-        colname = f"{bname}_RATE"
-        magname = f"{bname}_VEGA"
-        ot[fluxname] = Column(simflux)
-        ot[colname] = Column(ot[fluxname] / vega_flux[k])
-        pindxs = ot[colname] > 0.0
-        nindxs = ot[colname] <= 0.0
-        ot[magname] = Column(ot[colname])
-        ot[magname][pindxs] = -2.5 * np.log10(ot[colname][pindxs])
-        ot[magname][nindxs] = 99.999
+    for k, bname in enumerate(short_filters):
+        cols[f"{bname}_FLUX"] = simflux_all[:, k]
+        cols[f"{bname}_RATE"] = simrate_all[:, k]
+        cols[f"{bname}_VEGA"] = simmag_all[:, k]
 
         # add in the physical model values in a form similar to
         # the output simulated (physics+obs models) values
         # useful if using the simulated data to interpolate ASTs
         #   (e.g. for MATCH)
-        fluxname = f"{bname}_INPUT_FLUX"
-        ratename = f"{bname}_INPUT_RATE"
-        magname = f"{bname}_INPUT_VEGA"
-        ot[fluxname] = Column(flux[sim_indx, k])
-        ot[ratename] = Column(ot[fluxname] / vega_flux[k])
-        pindxs = ot[ratename] > 0.0
-        nindxs = ot[ratename] <= 0.0
-        ot[magname] = Column(ot[ratename])
-        ot[magname][pindxs] = -2.5 * np.log10(ot[ratename][pindxs])
-        ot[magname][nindxs] = 99.999
+        cols[f"{bname}_INPUT_FLUX"] = sim_flux_orig[:, k]
+        cols[f"{bname}_INPUT_RATE"] = inrate_all[:, k]
+        cols[f"{bname}_INPUT_VEGA"] = inmag_all[:, k]
 
     # model parmaeters
     for qname in qnames:
-        ot[qname] = Column(sedgrid[qname][sim_indx])
+        cols[qname] = sedgrid[qname][sim_indx]
 
-    return ot
+    return Table(cols)
@@ -0,0 +1,228 @@
+import numpy as np
+import pytest
+import tables
+
+from astropy.table import Table
+
+from beast.physicsmodel.grid import SEDGrid
+from beast.observationmodel import observations
+from beast.observationmodel.observations import Observations, gen_SimObs_from_sedgrid
+
+filters = ["HST_WFC3_F275W", "HST_WFC3_F475W", "HST_WFC3_F814W"]
+obs_colnames = ["F275W_RATE", "F475W_RATE", "F814W_RATE"]
+vega_lums = [2.5e-9, 6.3e-9, 1.1e-9]
+
+
+def make_vega_file(fname, vfilters, vlums):
+    """
+    Minimal vega file with the same layout as the BEAST library file
+    """
+    sed = np.zeros(
+        len(vfilters),
+        dtype=[("FNAME", "S20"), ("CWAVE", float), ("LUM", float), ("MAG", float)],
+    )
+    sed["FNAME"] = [f.encode("utf-8") for f in vfilters]
+    sed["CWAVE"] = np.linspace(2750.0, 8140.0, len(vfilters))
+    sed["LUM"] = vlums
+    sed["MAG"] = 0.03
+    with tables.open_file(fname, "w") as hdf:
+        hdf.create_table(hdf.root, "sed", sed)
+    return fname
+
+
+def make_sim_inputs(gfilters, glums, n_models=20):
+    """
+    Small in memory SED grid and noise model for simulating observations
+    """
+    seds = np.tile(np.array(glums), (n_models, 1)) * np.linspace(
+        0.5, 2.0, n_models
+    )[:, np.newaxis]
+    gtable = Table({"weight": np.linspace(1.0, 2.0, n_models)})
+    sedgrid = SEDGrid(
+        np.linspace(2750.0, 8140.0, len(gfilters)),
+        seds=seds,
+        grid=gtable,
+        header={"filters": " ".join(gfilters)},
+        backend="memory",
+    )
+
+    noisemodel = {
+        "bias": np.zeros(seds.shape),
+        "error": 0.1 * seds,
+        "completeness": np.ones(seds.shape),
+    }
+    return sedgrid, noisemodel
+
+
+@pytest.fixture
+def vega_fname(tmp_path):
+    return make_vega_file(str(tmp_path / "vega.hd5"), filters, vega_lums)
+
+
+@pytest.fixture
+def obs_table():
+    """
+    Small catalog with flux errors for only one of the filters
+    """
+    n_obs = 10
+    cols = {}
+    for k, cname in enumerate(obs_colnames):
+        cols[cname] = np.linspace(0.1, 1.0, n_obs) * (k + 1)
+    cols[f"{filters[1]}_err"] = np.full(n_obs, 0.05)
+    return Table(cols)
+
+
+def test_getfluxes(obs_table, vega_fname):
+    obs = Observations(obs_table, filters, obs_colnames, vega_fname=vega_fname)
+
+    # fluxes computed row by row from the catalog
+    exp_fluxes = np.array(
+        [
+            [obs_table[cname][k] for cname in obs_colnames]
+            for k in range(len(obs_table))
+        ]
+    ) * np.array(vega_lums)
+
+    np.testing.assert_allclose(obs.getFluxes(), exp_fluxes)
+    np.testing.assert_allclose(obs.getFluxes(3), exp_fluxes[3])
+    np.testing.assert_allclose(obs.getFluxes(slice(2, 6)), exp_fluxes[2:6])
+    indxs = np.array([0, 4, 9])
+    np.testing.assert_allclose(obs.getFluxes(indxs), exp_fluxes[indxs])
+    for k in range(len(obs_table)):
+        np.testing.assert_allclose(obs.getFlux(k), exp_fluxes[k])
+
+    # iterators give the same fluxes as getObs
+    for k, (e, flux) in enumerate(obs.enumobs()):
+        assert e == k, "enumobs index not in order"
+        np.testing.assert_allclose(flux, obs.getObs(k))
+    for k, flux in enumerate(obs.iterobs()):
+        np.testing.assert_allclose(flux, obs.getObs(k))
+    assert len(list(obs.iterobs())) == len(obs), "iterobs length not nObs"
+
+    # changing the filters changes the fluxes
+    obs.setFilters(filters[:2])
+    obs.setVegaFluxes(filters[:2], vega_fname=vega_fname)
+    np.testing.assert_allclose(obs.getFluxes(), exp_fluxes[:, :2])
+
+
+def test_getfluxerr(obs_table, vega_fname):
+    obs = Observations(obs_table, filters, obs_colnames, vega_fname=vega_fname)
+
+    fluxerr = obs.getFluxerr(0)
+    assert np.isnan(fluxerr[0]), "missing _err column not NaN"
+    np.testing.assert_allclose(fluxerr[1], 0.05)
+    assert np.isnan(fluxerr[2]), "missing _err column not NaN"
+
+
+@pytest.mark.parametrize("cformat", [".csv", ".fits"])
+def test_readdata(obs_table, vega_fname, tmp_path, cformat):
+    fname = str(tmp_path / f"obs{cformat}")
+    obs_table.write(fname)
+
+    obs = Observations(fname, filters, obs_colnames, vega_fname=vega_fname)
+
+    assert obs.data.colnames == obs_table.colnames, "colnames not equal"
+    for cname in obs_table.colnames:
+        np.testing.assert_allclose(obs.data[cname], obs_table[cname])
+    np.testing.assert_allclose(
+        obs.getFluxes(), np.array([obs_table[c] for c in obs_colnames]).T * vega_lums
+    )
+
+
+def test_gen_simobs_dtype(vega_fname):
+    sedgrid, noisemodel = make_sim_inputs(filters, vega_lums)
+
+    simtables = {}
+    for dtype in [np.float64, np.float32]:
+        simtables[dtype] = gen_SimObs_from_sedgrid(
+            sedgrid,
+            noisemodel,
+            nsim=50,
+            ranseed=1234,
+            vega_fname=vega_fname,
+            dtype=dtype,
+        )
+        assert len(simtables[dtype]) == 50, "number of simulated stars not nsim"
+
+    for cfilt in ["F275W", "F475W", "F814W"]:
+        for ctype in ["FLUX", "RATE", "VEGA", "INPUT_FLUX", "INPUT_RATE", "INPUT_VEGA"]:
+            cname = f"{cfilt}_{ctype}"
+            for dtype in simtables.keys():
+                assert simtables[dtype][cname].dtype == dtype, f"{cname} not {dtype}"
+            # same simulation to float32 precision
+            np.testing.assert_allclose(
+                simtables[np.float32][cname],
+                simtables[np.float64][cname],
+                rtol=1e-5,
+                atol=1e-5 if ctype.endswith("VEGA") else 0.0,
+            )
+    for dtype in simtables.keys():
+        assert simtables[dtype]["weight"].dtype == np.float64, "model dtype changed"
+
+    with pytest.raises(ValueError):
+        gen_SimObs_from_sedgrid(
+            sedgrid, noisemodel, nsim=5, vega_fname=vega_fname, dtype=np.float16
+        )
+
+
+def test_gen_simobs_compl_filter_duplicate_band(tmp_path, capsys):
+    # two filters with the same band name, the first one should be used
+    dfilters = ["HST_WFC3_F475W", "HST_ACS_WFC_F475W", "HST_WFC3_F814W"]
+    dlums = [6.3e-9, 6.1e-9, 1.1e-9]
+    dvega_fname = make_vega_file(str(tmp_path / "vega_dup.hd5"), dfilters, dlums)
+    sedgrid, noisemodel = make_sim_inputs(dfilters, dlums)
+
+    gen_SimObs_from_sedgrid(
+        sedgrid,
+        noisemodel,
+        nsim=10,
+        compl_filter="F475W",
+        ranseed=1234,
+        vega_fname=dvega_fname,
+    )
+
+    out = capsys.readouterr().out
+    assert "Completeness from HST_WFC3_F475W" in out, "first F475W filter not used"
+
+
+def test_gen_simobs_numexpr_fallback(vega_fname, monkeypatch):
+    # simulated fluxes with and without numexpr
+    sedgrid, noisemodel = make_sim_inputs(filters, vega_lums)
+    simtables = {}
+    for use_numexpr in [True, False]:
+        monkeypatch.setattr(observations, "__USE_NUMEXPR__", use_numexpr)
+        simtables[use_numexpr] = gen_SimObs_from_sedgrid(
+            sedgrid, noisemodel, nsim=50, ranseed=1234, vega_fname=vega_fname
+        )
+
+    for cname in simtables[True].colnames:
+        if cname.endswith("_VEGA"):
+            # numexpr log10 can differ by 1 ulp
+            np.testing.assert_allclose(
+                simtables[False][cname],
+                simtables[True][cname],
+                rtol=1e-15,
+                atol=1e-15,
+            )
+        else:
+            np.testing.assert_array_equal(
+                simtables[False][cname], simtables[True][cname]
+            )
+
+
+@pytest.mark.parametrize("use_numexpr", [True, False])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_rate_to_vegamag(monkeypatch, use_numexpr, dtype):
+    monkeypatch.setattr(observations, "__USE_NUMEXPR__", use_numexpr)
+    rate = np.array([-1.0, 0.0, np.nan, 1e-3, 0.5, 1.0, 10.0], dtype=dtype)
+
+    mag = observations._rate_to_vegamag(rate)
+
+    assert mag.dtype == dtype, f"mag dtype not {dtype}"
+    np.testing.assert_array_equal(mag[:2], dtype(99.999))
+    assert np.isnan(mag[2]), "NaN rate does not give a NaN mag"
+    exp_mag = -2.5 * np.log10(rate[3:].astype(np.float64))
+    if dtype == np.float64:
+        np.testing.assert_allclose(mag[3:], exp_mag, rtol=1e-15, atol=1e-15)
+    else:
+        np.testing.assert_allclose(mag[3:], exp_mag, rtol=1e-6, atol=1e-6)